@@ -1,11 +1,21 @@
+import asyncio
+import hashlib
+import logging
 import os
-from typing import List, Optional
-import re
-
-from fastapi import FastAPI
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from functools import lru_cache, partial
+from typing import Annotated, List, Optional
+
+import anyio
+import orjson
+from fastapi import Body, FastAPI
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from pydantic import BaseModel, ValidationError
 from google import genai
+from google.genai import errors, types
 
 
 class AjusteRequest(BaseModel):
@@ -24,152 +34,369 @@ class AjusteResponse(BaseModel):
     rawText: Optional[str] = None
 
 
-def parse_raw_text(text: str) -> tuple[str, Optional[str], List[str]]:
-    """Extrai diagnostico, ajusteCarga e recomendações de autocuidado do texto rico da IA.
+class AjusteIA(BaseModel):
+    """Valida a saída JSON do Gemini (o schema enviado à API é _SCHEMA_AJUSTE_IA)."""
 
-    A lógica é simples e tolerante: se algo não for encontrado, devolve valores seguros.
-    """
-    if not text:
-        return "Texto livre recebido.", None, ["Pausa leve 5m"]
-
-    # Normaliza quebras de linha e remove excesso de espaços
-    normalized = text.replace("\r", "")
-
-    # 1) Diagnóstico Rápido: pegamos o parágrafo após o título correspondente
-    diag = None
-    m_diag = re.search(r"diagn[óo]stico\s+r[áa]pido[:\n]*(.+?)(?:\n\s*\n|\n\s*\*\*Ajuste|\Z)", normalized, re.IGNORECASE | re.DOTALL)
-    if m_diag:
-        diag_raw = m_diag.group(1)
-        diag = " ".join(line.strip() for line in diag_raw.strip().split("\n") if line.strip())
-
-    # 2) Ajuste de Carga: parágrafo após o título correspondente
-    ajuste = None
-    m_aj = re.search(r"ajuste\s+de\s+carga\s+sugerido[:\n]*(.+?)(?:\n\s*\n|\n\s*\*\*Recomenda|\Z)", normalized, re.IGNORECASE | re.DOTALL,
-)
-    if m_aj:
-        aj_raw = m_aj.group(1)
-        ajuste = " ".join(line.strip() for line in aj_raw.strip().split("\n") if line.strip())
-
-    # 3) Recomendações de Autocuidado: linhas numeradas (1., 2., etc) depois da seção
-    recs: List[str] = []
-    m_auto = re.search(r"recomenda[çc][ãa]o\s+de\s+autocuidado[:\n]*(.+)", normalized, re.IGNORECASE | re.DOTALL)
-    if m_auto:
-        bloco = m_auto.group(1)
-        for line in bloco.split("\n"):
-            line = line.strip(" -*\t")
-            m_item = re.match(r"\d+\.\s*(.+)", line)
-            if m_item:
-                item = m_item.group(1).strip()
-                if item:
-                    recs.append(item)
-
-    if not diag:
-        # fallback: primeira linha não vazia
-        for line in normalized.split("\n"):
-            line = line.strip()
-            if line:
-                diag = line
-                break
-    if not diag:
-        diag = "Texto livre recebido."
+    diagnostico: str
+    ajusteCarga: Optional[str] = None
+    recomendacoesAutocuidado: List[str]
 
-    if not recs:
-        recs = ["Pausa leve 5m"]
 
-    return diag, ajuste, recs
+logger = logging.getLogger("soulbalance")
 
+# Origens liberadas no CORS, separadas por vírgula (ex: "https://app.exemplo.com,https://admin.exemplo.com")
+CORS_ORIGINS = [o.strip() for o in os.getenv("CORS_ORIGINS", "*").split(",") if o.strip()]
 
 API_KEY = os.getenv("GEMINI_API_KEY") or ""
 MODEL_NAME = os.getenv("GEMINI_MODEL", "gemini-2.5-flash")
+# Número de chamadas bloqueantes ao Gemini que podem rodar em paralelo no pool de threads
+GEMINI_MAX_THREADS = int(os.getenv("GEMINI_MAX_THREADS", 200))
+# Cache em memória das respostas da IA (entradas idênticas geram a mesma análise)
+CACHE_MAX = int(os.getenv("AJUSTE_CACHE_MAX", 4096))
+CACHE_TTL = float(os.getenv("AJUSTE_CACHE_TTL", 3600))
+# Máximo de itens aceitos por chamada ao endpoint de lote
+AJUSTE_LOTE_MAX_ITENS = int(os.getenv("AJUSTE_BATCH_MAX_ITEMS", 100))
+# Teto de tokens gerados; nos modelos 2.5 o raciocínio interno também conta nesse limite
+MAX_OUTPUT_TOKENS = int(os.getenv("GEMINI_MAX_OUTPUT_TOKENS", 1024))
+
+# Schema explícito em vez de response_schema=AjusteIA: o google-genai 0.3.0 converte
+# Optional[str] em anyOf com type NULL, que o próprio SDK rejeita antes de enviar.
+# Precisa ser dict: nessa versão só dicts são repassados sem conversão (até um
+# types.Schema passaria pelo model_json_schema da classe).
+_SCHEMA_AJUSTE_IA = {
+    "type": "OBJECT",
+    "properties": {
+        "diagnostico": {"type": "STRING"},
+        "ajusteCarga": {"type": "STRING", "nullable": True},
+        "recomendacoesAutocuidado": {"type": "ARRAY", "items": {"type": "STRING"}},
+    },
+    "required": ["diagnostico", "recomendacoesAutocuidado"],
+}
+
+_CONFIG_GERACAO = types.GenerateContentConfig(
+    response_mime_type="application/json",
+    response_schema=_SCHEMA_AJUSTE_IA,
+    max_output_tokens=MAX_OUTPUT_TOKENS,
+)
+
+# No streaming o SDK 0.3.0 faz json.loads de cada trecho quando há response_schema,
+# e trechos parciais de JSON quebram a chamada. Sem o schema, o JSON completo
+# ainda é validado pelo AjusteIA em montar_resposta.
+_CONFIG_STREAM = types.GenerateContentConfig(
+    response_mime_type="application/json",
+    max_output_tokens=MAX_OUTPUT_TOKENS,
+)
+
 
-try:
-    client = genai.Client(api_key=API_KEY)
-except Exception:
-    client = None
+@lru_cache(maxsize=None)
+def obter_cliente() -> Optional[genai.Client]:
+    """Cria o cliente do Gemini na primeira chamada de cada processo.
+
+    Com vários workers, cada processo precisa da sua própria conexão; um cliente
+    criado no import seria herdado pelos forks.
+    """
+    try:
+        return genai.Client(api_key=API_KEY)
+    except Exception:
+        return None
+
+
+# Parte estática do prompt: montada uma única vez no import. Os dados do usuário
+# ficam no final para que só o sufixo curto seja gerado a cada requisição.
+# O texto é propositalmente enxuto (cada token enviado custa latência e dinheiro);
+# o formato da resposta é garantido pelo response_schema de _CONFIG_GERACAO.
+_PROMPT_PREFIX = """Você é o "SoulBalance AI", consultor de produtividade e bem-estar. Analise os dados do dia do usuário e sugira ajustes de carga e autocuidado para performance sustentável, sem burnout.
+
+Campos da resposta:
+- diagnostico: estado do usuário em uma frase (ex: "fadiga leve, foco baixo").
+- ajusteCarga: Recuperação > 7 e Fadiga < 3: manter carga ou focar em tarefas complexas. Recuperação < 5 ou Fadiga > 6: reduzir carga (ex: -20% de duração) e/ou trocar foco (soft skills, atividades criativas). null se não houver ajuste.
+- recomendacoesAutocuidado: 1 ou 2 ações específicas (pausa, meditação, exercício leve).
+
+Dados:"""
 
 
 def criar_prompt(req: AjusteRequest) -> str:
-    base = """Você é o "SoulBalance AI", um consultor de produtividade focado em bem-estar. Sua função é analisar dados diários de bem-estar e performance de um usuário para fornecer **ajustes de carga de trabalho e recomendações de autocuidado**.
-
-**OBJETIVO:** Garantir a performance sustentável do usuário, evitando o burnout e otimizando a recuperação.
-
-**ENTRADA DE DADOS:**
-
-* **Status de Recuperação (0-10):** {rec}
-* **Fadiga Percebida (0-10):** {fad}
-* **Nível de Foco (0-10):** {foc}
-* **Horas de Sono (última noite):** {sono}
-* **Tipo de Tarefa/Missão Principal do Dia:** {tarefa}
-
-**INSTRUÇÕES DE SAÍDA:**
-
-1. **Diagnóstico Rápido:** Avalie o estado do usuário (ex: "Sinais de fadiga leve, foco baixo").
-2. **Ajuste de Carga Sugerido (Se Necessário):**
-   * Se a Recuperação for alta (> 7) e a Fadiga baixa (< 3), recomende **manter a carga ou focar em tarefas complexas**.
-   * Se a Recuperação for baixa (< 5) ou a Fadiga alta (> 6), recomende **redução de carga** (ex: reduzir duração da tarefa em 20%) e/ou **troca de foco** (ex: priorizar soft skills ou atividades criativas).
-3. **Recomendação de Autocuidado (Obrigatória):** Sugira 1 ou 2 ações específicas (pausa, meditação, exercício leve) com base na análise.
-"""
-    return base.format(
-        rec=req.recoveryStatus,
-        fad=req.perceivedFatigue,
-        foc=req.focusLevel,
-        sono=req.sleepHours,
-        tarefa=req.mainTask,
+    return _PROMPT_PREFIX + (
+        f"\n- Recuperação (0-10): {req.recoveryStatus}"
+        f"\n- Fadiga (0-10): {req.perceivedFatigue}"
+        f"\n- Foco (0-10): {req.focusLevel}"
+        f"\n- Sono (h): {req.sleepHours}"
+        f"\n- Tarefa principal: {req.mainTask}"
     )
 
 
-app = FastAPI(title="SoulBalance AI", version="1.0.0")
+def _ler_json_ia(text: str) -> Optional[AjusteIA]:
+    """Lê a saída JSON do Gemini; devolve None se não houver JSON válido no schema."""
+    try:
+        return AjusteIA.model_validate(orjson.loads(text))
+    except orjson.JSONDecodeError:
+        pass
+    except ValidationError:
+        return None
+    # JSON cercado por texto (ex: bloco ```json): tenta só o trecho entre as chaves
+    inicio, fim = text.find("{"), text.rfind("}")
+    if inicio == -1 or fim <= inicio:
+        return None
+    try:
+        return AjusteIA.model_validate(orjson.loads(text[inicio:fim + 1]))
+    except (orjson.JSONDecodeError, ValidationError):
+        return None
+
+
+def montar_resposta(text: str) -> tuple[AjusteResponse, bool]:
+    """Monta a resposta da API e indica se a saída da IA veio no schema esperado."""
+    dados = _ler_json_ia(text)
+    if dados is None:
+        # Saída truncada ou fora do schema: não há o que aproveitar, o texto vai no rawText
+        return resposta_falha(text), False
+    # Os campos já passaram pelo AjusteIA; model_construct evita revalidá-los
+    resposta = AjusteResponse.model_construct(
+        diagnostico=dados.diagnostico,
+        ajusteCarga=dados.ajusteCarga,
+        recomendacoesAutocuidado=dados.recomendacoesAutocuidado or ["Pausa leve 5m"],
+        planoDia=None,
+        rawText=text,
+    )
+    return resposta, True
+
+
+# Modelo da resposta de falha, criado uma vez; cada erro só troca o rawText
+_RESPOSTA_FALHA = AjusteResponse.model_construct(
+    diagnostico="Falha na IA",
+    ajusteCarga=None,
+    recomendacoesAutocuidado=["Respiração 4-7-8", "Alongamento rápido"],
+    planoDia=None,
+    rawText=None,
+)
+
+
+# Falhas esperadas quando o Gemini está degradado. Timeouts e quedas de conexão do
+# transporte do SDK (requests no 0.3.0) são subclasses de OSError, assim como os
+# TimeoutError/ConnectionError nativos, então não é preciso importar o transporte.
+_ERROS_TRANSITORIOS = (errors.ServerError, OSError)
+
+
+def registrar_falha(e: Exception) -> None:
+    """Loga falhas do Gemini; traceback completo só para erros inesperados.
+
+    Timeouts e limites de cota chegam em rajadas quando o serviço degrada, e
+    formatar um traceback para cada um só aumentaria a carga nesse momento.
+    """
+    if isinstance(e, _ERROS_TRANSITORIOS) or (
+        isinstance(e, errors.ClientError) and e.code == 429
+    ):
+        logger.warning("Gemini indisponível (%s): %s", type(e).__name__, e)
+    else:
+        logger.exception("Falha inesperada ao chamar o Gemini")
+
+
+def resposta_falha(detalhe: str) -> AjusteResponse:
+    # Cópia rasa: a lista de recomendações é compartilhada e nunca é alterada
+    return _RESPOSTA_FALHA.model_copy(update={"rawText": detalhe})
+
+
+_cache: "OrderedDict[bytes, tuple[float, AjusteResponse]]" = OrderedDict()
+
+
+def chave_cache(req: AjusteRequest) -> bytes:
+    """Digest curto das entradas normalizadas, calculado antes de montar o prompt.
+
+    O tamanho fixo mantém o cache limitado em memória mesmo com mainTask longos.
+    """
+    bruto = (
+        f"{req.recoveryStatus}|{req.perceivedFatigue}|{req.focusLevel}|"
+        f"{req.sleepHours:.1f}|{req.mainTask.strip().lower()}"
+    )
+    return hashlib.blake2b(bruto.encode(), digest_size=16).digest()
+
+
+def buscar_cache(chave: bytes) -> Optional[AjusteResponse]:
+    item = _cache.get(chave)
+    if item is None:
+        return None
+    expira_em, resposta = item
+    if expira_em < time.monotonic():
+        del _cache[chave]
+        return None
+    _cache.move_to_end(chave)
+    return resposta
+
+
+def salvar_cache(chave: bytes, resposta: AjusteResponse) -> None:
+    _cache[chave] = (time.monotonic() + CACHE_TTL, resposta)
+    _cache.move_to_end(chave)
+    while len(_cache) > CACHE_MAX:
+        _cache.popitem(last=False)
 
+
+@asynccontextmanager
+async def ciclo_de_vida(app: FastAPI):
+    # As chamadas ao Gemini são I/O-bound; o limite padrão do anyio (40 threads) seria o gargalo
+    anyio.to_thread.current_default_thread_limiter().total_tokens = GEMINI_MAX_THREADS
+    yield
+
+
+app = FastAPI(
+    title="SoulBalance AI",
+    version="1.0.0",
+    default_response_class=ORJSONResponse,
+    lifespan=ciclo_de_vida,
+)
+
+# A API não usa cookies, então credenciais ficam desligadas ("*" com credenciais é
+# recusado pelos navegadores). Métodos e headers fixos deixam o preflight simples.
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_origins=CORS_ORIGINS,
+    allow_credentials=False,
+    allow_methods=["GET", "POST"],
+    allow_headers=["content-type"],
 )
 
 
+async def gerar_conteudo(prompt: str):
+    """Chama o Gemini numa thread do pool do anyio para não bloquear o event loop."""
+    return await anyio.to_thread.run_sync(
+        partial(
+            obter_cliente().models.generate_content,
+            model=MODEL_NAME,
+            contents=prompt,
+            config=_CONFIG_GERACAO,
+        )
+    )
+
+
+@lru_cache(maxsize=None)
+def _corpo_healthz() -> bytes:
+    # Nada aqui muda depois que o cliente do processo é criado
+    return orjson.dumps(
+        {"ok": True, "model": MODEL_NAME, "hasKey": bool(API_KEY), "clientReady": obter_cliente() is not None}
+    )
+
+
+# async de propósito: uma rota sync ocuparia uma vaga no mesmo pool de threads das
+# chamadas ao Gemini, e o probe ficaria na fila atrás delas quando o upstream trava
 @app.get("/healthz")
-def healthz():
-    return {"ok": True, "model": MODEL_NAME, "hasKey": bool(API_KEY), "clientReady": client is not None}
+async def healthz():
+    return Response(_corpo_healthz(), media_type="application/json")
+
+
+CLIENTE_INDISPONIVEL = "Cliente Gemini não inicializado. Verifique GEMINI_API_KEY."
+
+# Chamadas ao Gemini em andamento, por chave de cache: requisições idênticas que
+# chegam juntas aguardam a mesma tarefa em vez de disparar chamadas duplicadas.
+_em_voo: "dict[bytes, asyncio.Task]" = {}
+
+
+async def _gerar_resposta(chave: bytes, req: AjusteRequest) -> AjusteResponse:
+    prompt = criar_prompt(req)
+    try:
+        response = await gerar_conteudo(prompt)
+        text = getattr(response, "text", None)
+        resposta, valida = montar_resposta(text or str(response))
+        # Só guarda saídas completas; vazias (ex: MAX_TOKENS) ou fora do schema são refeitas
+        if text and valida:
+            salvar_cache(chave, resposta)
+        return resposta
+    except Exception as e:
+        registrar_falha(e)
+        return resposta_falha(str(e))
+
+
+async def calcular_ajuste(req: AjusteRequest) -> AjusteResponse:
+    if obter_cliente() is None:
+        return resposta_falha(CLIENTE_INDISPONIVEL)
+
+    chave = chave_cache(req)
+    cached = buscar_cache(chave)
+    if cached is not None:
+        return cached
+
+    # Sem await entre a consulta e o registro, então não há corrida no event loop
+    tarefa = _em_voo.get(chave)
+    if tarefa is None:
+        tarefa = asyncio.create_task(_gerar_resposta(chave, req))
+        _em_voo[chave] = tarefa
+        tarefa.add_done_callback(lambda _: _em_voo.pop(chave, None))
+    # shield: se um dos clientes cancelar, a chamada continua para os demais
+    return await asyncio.shield(tarefa)
 
 
 @app.post("/api/ai/ajuste", response_model=AjusteResponse)
-def ajustar_carga(req: AjusteRequest):
+async def ajustar_carga(req: AjusteRequest):
+    return await calcular_ajuste(req)
+
+
+@app.post("/api/ai/ajuste/batch", response_model=List[AjusteResponse])
+async def ajustar_carga_lote(
+    reqs: Annotated[List[AjusteRequest], Body(max_length=AJUSTE_LOTE_MAX_ITENS)],
+):
+    # Cada item passa por cache e single-flight, então entradas repetidas no
+    # mesmo lote resultam numa única chamada ao Gemini
+    return await asyncio.gather(*(calcular_ajuste(req) for req in reqs))
+
+
+def _linha_ndjson(obj: dict) -> bytes:
+    return orjson.dumps(obj) + b"\n"
+
+
+async def _stream_ajuste(req: AjusteRequest):
+    """Emite os trechos do Gemini como {"delta": ...} e fecha com {"resultado": ...}."""
+    client = obter_cliente()
     if client is None:
-        return AjusteResponse(
-            diagnostico="Falha na IA",
-            ajusteCarga=None,
-            recomendacoesAutocuidado=["Respiração 4-7-8", "Alongamento rápido"],
-            planoDia=None,
-            rawText="Cliente Gemini não inicializado. Verifique GEMINI_API_KEY.",
-        )
+        yield _linha_ndjson({"resultado": resposta_falha(CLIENTE_INDISPONIVEL).model_dump()})
+        return
+
+    chave = chave_cache(req)
+    cached = buscar_cache(chave)
+    if cached is not None:
+        yield _linha_ndjson({"resultado": cached.model_dump()})
+        return
 
     prompt = criar_prompt(req)
+    partes: List[str] = []
     try:
-        response = client.models.generate_content(
-            model=MODEL_NAME,
-            contents=prompt,
-        )
-        text = getattr(response, "text", None) or str(response)
-        diagnostico, ajuste, recs = parse_raw_text(text)
-        return AjusteResponse(
-            diagnostico=diagnostico,
-            ajusteCarga=ajuste,
-            recomendacoesAutocuidado=recs,
-            planoDia=None,
-            rawText=text,
+        # O iterador do SDK é síncrono: cada próximo trecho é buscado numa thread
+        chunks = await anyio.to_thread.run_sync(
+            partial(
+                client.models.generate_content_stream,
+                model=MODEL_NAME,
+                contents=prompt,
+                config=_CONFIG_STREAM,
+            )
         )
+        chunks = iter(chunks)
+        while True:
+            chunk = await anyio.to_thread.run_sync(next, chunks, None)
+            if chunk is None:
+                break
+            delta = getattr(chunk, "text", None)
+            if delta:
+                partes.append(delta)
+                yield _linha_ndjson({"delta": delta})
+        text = "".join(partes)
+        resposta, valida = montar_resposta(text)
+        if text and valida:
+            salvar_cache(chave, resposta)
     except Exception as e:
-        return AjusteResponse(
-            diagnostico="Falha na IA",
-            ajusteCarga=None,
-            recomendacoesAutocuidado=["Respiração 4-7-8", "Alongamento rápido"],
-            planoDia=None,
-            rawText=str(e),
-        )
+        registrar_falha(e)
+        resposta = resposta_falha(str(e))
+    yield _linha_ndjson({"resultado": resposta.model_dump()})
+
+
+@app.post("/api/ai/ajuste/stream")
+async def ajustar_carga_stream(req: AjusteRequest):
+    return StreamingResponse(_stream_ajuste(req), media_type="application/x-ndjson")
 
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=int(os.getenv("PORT", 8000)))
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=int(os.getenv("PORT", 8000)),
+        workers=int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 1)),
+        # "auto" usa uvloop e httptools (instalados pelo uvicorn[standard]) quando disponíveis
+        loop="auto",
+        http="auto",
+    )